@@ -19,10 +19,10 @@ setup(name='shapes', version='0.1',\
     packages=['shapes'])
 
 SHAPES_env = os.getenv('SHAPES')
+shell = os.getenv('SHELL')
 cwd = os.getcwd()
 if not SHAPES_env:
     import re
-    shell = os.getenv('SHELL')
     print("\n")
     print("#" * 78)
     print("It would be in your best interest to set an environment variable")
@@ -44,7 +44,7 @@ elif SHAPES_env != cwd:
     print("#" * 78)
     print("It looks like you've already got an shapes environment variable " +\
         "set but it's \npointing to a different directory:")
-    print("\n    SHAPES={!s}".format(shapes_env))
+    print("\n    SHAPES={!s}".format(SHAPES_env))
     print("\nHowever, we're currently in {!s}.\n".format(cwd))
     print("Is this a different shapes install (might not cause problems), or " +\
         "perhaps just")
@@ -8,12 +8,20 @@ Description: File containing BaseHorizonCalculator class which contains common
              LunarHorizonCalculator classes.
 """
 import os
+import math
 import time
+import hashlib
+import threading
 import numpy as np
-import elevation
-import richdem as rd
-import matplotlib.pyplot as plt
-from scipy.interpolate import RectBivariateSpline
+from concurrent.futures import ThreadPoolExecutor
+from scipy.ndimage import spline_filter, map_coordinates
+from . import horizon_kernels
+
+_DEG2RAD = np.pi / 180.
+_RAD2DEG = 180. / np.pi
+# maximum number of (alpha, gamma) points evaluated at once by the NumPy
+# implementation of horizon_profile
+_MAX_CHUNK_POINTS = 2 ** 16
 
 class BaseHorizonCalculator(object):
     """
@@ -33,7 +41,10 @@ class BaseHorizonCalculator(object):
     @observer_coordinates.setter
     def observer_coordinates(self, coordinates):
         """
-        Setter for the coordinates of the observer.
+        Setter for the coordinates of the observer. The observer's
+        colatitude (theta_0) and longitude (phi_0) in radians and the sine
+        and cosine of theta_0 are also stored so that find_lon_lat doesn't
+        need to recompute them.
 
         coordinates: (longitude, latitude) in degrees
         """
@@ -44,6 +55,10 @@ class BaseHorizonCalculator(object):
             raise ValueError('Latitude coordinate must be between ' +\
                 '-90 and 90 degrees')
         self._observer_coordinates = coordinates
+        self._theta_0 = (np.pi / 2.) - (coordinates[1] * _DEG2RAD)
+        self._phi_0 = coordinates[0] * _DEG2RAD
+        self._cos_theta_0 = math.cos(self._theta_0)
+        self._sin_theta_0 = math.sin(self._theta_0)
 
     @property
     def gamma_min(self):
@@ -97,10 +112,20 @@ class BaseHorizonCalculator(object):
         Property storing the elevation of the observer.
         """
         if not hasattr(self, '_observer_elevation'):
-            self._observer_elevation = self.interpolate_elevation(0., 0.) +\
-                self.observer_height
+            self._observer_elevation =\
+                float(self.interpolate_elevation(0., 0.)) + self.observer_height
         return self._observer_elevation
 
+    @property
+    def observer_radius(self):
+        """
+        Property storing the distance of the observer from the center of the
+        body, i.e. body_radius + observer_elevation (in meters).
+        """
+        if not hasattr(self, '_observer_radius'):
+            self._observer_radius = self.body_radius + self.observer_elevation
+        return self._observer_radius
+
     @property
     def bounds(self):
         """
@@ -111,11 +136,8 @@ class BaseHorizonCalculator(object):
                 max(self.observer_coordinates[1] - self.gamma_max, -90.)
             lat_upper_bound =\
                 min(self.observer_coordinates[1] + self.gamma_max, 90.)
-            lon_arr = []
-            for angle in np.arange(0., 360., 0.01):
-                lon_arr += [self.find_lon_lat(np.radians(angle),\
-                    np.radians(self.gamma_max))[0]]
-            lon_arr = np.array(lon_arr) % 360.
+            lon_arr = self.find_lon_lat(np.radians(np.arange(0., 360., 0.01)),\
+                np.radians(self.gamma_max), wrap_longitude=False)[0] % 360.
             lon_lower_bound = np.amin(lon_arr)
             if (lon_lower_bound > 180.):
                 lon_lower_bound = (lon_lower_bound % 180.) - 180.
@@ -142,6 +164,50 @@ class BaseHorizonCalculator(object):
         #        'top boundary')
         self._bounds = bounds
 
+    @property
+    def grid_width_longitude(self):
+        """
+        Property storing the size of the elevation grid in longitude.
+        Defaults to the default_grid_width of the class.
+        """
+        if not hasattr(self, '_grid_width_longitude'):
+            self._grid_width_longitude = self.default_grid_width
+        return self._grid_width_longitude
+
+    @grid_width_longitude.setter
+    def grid_width_longitude(self, value):
+        """
+        Setter for the grid_width_longitude property.
+
+        Value: positive number greater than gamma_max
+        """
+        if value < self.gamma_max:
+            raise ValueError('grid_width_longitude must be larger ' +\
+                'than gamma_max.')
+        self._grid_width_longitude = value
+
+    @property
+    def grid_width_latitude(self):
+        """
+        Property storing the size of the elevation grid in latitude.
+        Defaults to the default_grid_width of the class.
+        """
+        if not hasattr(self, '_grid_width_latitude'):
+            self._grid_width_latitude = self.default_grid_width
+        return self._grid_width_latitude
+
+    @grid_width_latitude.setter
+    def grid_width_latitude(self, value):
+        """
+        Setter for the grid_width_latitude property.
+
+        Value: positive number greater than gamma_max
+        """
+        if value < self.gamma_max:
+            raise ValueError('grid_width_latitude must be larger ' +\
+                'than gamma_max.')
+        self._grid_width_latitude = value
+
     @property
     def includes_pole(self):
         """
@@ -159,10 +225,12 @@ class BaseHorizonCalculator(object):
     def elevation_interpolation_degree(self):
         """
         Property storing the degree of the spline to use in interpolating
-        the elevation data grid.
+        the elevation data grid. Defaults to 1 (bilinear interpolation),
+        which is sufficient when the gamma spacing is comparable to the
+        grid resolution. Set to 3 for bicubic interpolation.
         """
         if not hasattr(self, '_elevation_interpolation_degree'):
-            self._elevation_interpolation_degree = 3
+            self._elevation_interpolation_degree = 1
         return self._elevation_interpolation_degree
 
     @elevation_interpolation_degree.setter
@@ -170,37 +238,223 @@ class BaseHorizonCalculator(object):
         """
         Setter for the elevation_interpolation_degree property.
 
-        value: integer
+        value: integer between 1 and 5
         """
-        if value <= 0:
-            return ValueError('elevation_interpolation_degree must be a' +\
-                'positive integer')
+        if (value <= 0) or (value > 5):
+            raise ValueError('elevation_interpolation_degree must be an ' +\
+                'integer between 1 and 5')
         self._elevation_interpolation_degree = value
 
     @property
-    def elevation_interpolation_function(self):
-        """
-        Property storing the function that interpolates the elevation data
-        between grid points. This step may take longer for locations near
-        the North or South Pole because there are more grid points to
-        interpolate between.
-        """
-        if not hasattr(self, '_elevation_interpolation_function'):
-            print('Starting elevation interpolation...')
-            t_start_interp = time.time()
-            lon_array = np.linspace(self.bounds[0] % 360., self.bounds[2] % 360.,\
-                self.elevation_grid.shape[1], endpoint=True)
-            lat_array = np.linspace(self.bounds[1], self.bounds[3],\
-       	       	self.elevation_grid.shape[0], endpoint=True)
-            self._elevation_interpolation_function = RectBivariateSpline(\
-                lon_array, lat_array, np.flip(self.elevation_grid.T, axis=1),\
-                kx=self.elevation_interpolation_degree,\
-                ky=self.elevation_interpolation_degree)
-            print('Interpolated elevation data in %.2f minutes' %\
-                ((time.time() - t_start_interp) / 60.))
-        return self._elevation_interpolation_function
-
-    def find_lon_lat(self, alpha, gamma):
+    def num_threads(self):
+        """
+        Property storing the number of threads used to calculate the horizon
+        profile. Defaults to the number of CPUs.
+        """
+        if not hasattr(self, '_num_threads'):
+            self._num_threads = os.cpu_count() or 1
+        return self._num_threads
+
+    @num_threads.setter
+    def num_threads(self, value):
+        """
+        Setter for the num_threads property.
+
+        value: positive integer
+        """
+        if value < 1:
+            raise ValueError('num_threads must be a positive integer.')
+        self._num_threads = int(value)
+
+    @property
+    def verbose(self):
+        """
+        Property storing whether messages about the progress of slow steps
+        (e.g. reading and interpolating the elevation data) are printed.
+        Defaults to True.
+        """
+        if not hasattr(self, '_verbose'):
+            self._verbose = True
+        return self._verbose
+
+    @verbose.setter
+    def verbose(self, value):
+        """
+        Setter for the verbose property.
+
+        value: True or False
+        """
+        self._verbose = bool(value)
+
+    @property
+    def cache_directory(self):
+        """
+        Property storing the directory in which to cache arrays that are
+        expensive to compute, e.g. os.path.join(os.getenv('SHAPES'),
+        'cache'). Defaults to None, in which case nothing is cached. Nothing
+        is ever removed from the cache, and each location can add up to two
+        arrays the size of its elevation grid (the grid itself and, for
+        interpolation degrees above 1, its spline coefficients), which come
+        to several hundred MB for a lunar location with the default
+        gamma_max.
+        """
+        if not hasattr(self, '_cache_directory'):
+            self._cache_directory = None
+        return self._cache_directory
+
+    @cache_directory.setter
+    def cache_directory(self, value):
+        """
+        Setter for the cache_directory property.
+
+        value: path to a directory (created if it doesn't exist) or None
+        """
+        self._cache_directory = value
+
+    def cache_path(self, name, *key):
+        """
+        Finds the path in the cache directory of the file storing an array.
+
+        name: name of the array, used as the prefix of the file name
+        key: values (in addition to the class and bounds) which determine
+             the contents of the array
+
+        Returns the path to the file, or None if cache_directory is None or
+        can't be created.
+        """
+        if self.cache_directory is None:
+            return None
+        if not os.path.exists(self.cache_directory):
+            try:
+                os.makedirs(self.cache_directory, exist_ok=True)
+            except OSError as error:
+                if self.verbose:
+                    print(('Not caching {0!s} because the cache ' +\
+                        'directory could not be created: {1!s}').format(name,\
+                        error))
+                return None
+        key = (type(self).__name__,\
+            tuple(float(bound) for bound in self.bounds)) + key
+        return os.path.join(self.cache_directory, '{0!s}_{1!s}.npy'.format(\
+            name, hashlib.sha1(repr(key).encode()).hexdigest()))
+
+    def save_to_cache(self, cache_path, array):
+        """
+        Saves an array to the given path in the cache directory. The array
+        is written to a temporary file with a unique name first, so that
+        other threads and processes never read (or write to) a partially
+        written file. If the array can't be written (e.g. because the cache
+        directory is read-only or the disk is full), nothing is cached.
+
+        cache_path: path returned by cache_path
+        array: numpy.ndarray to save
+        """
+        # the name is unique to this process and thread. Unlike a file made
+        # by tempfile.mkstemp, it gets the usual permissions, so a shared
+        # cache stays readable by others
+        temporary_path = '{0!s}.{1:d}.{2:d}.tmp'.format(cache_path,\
+            os.getpid(), threading.get_ident())
+        try:
+            with open(temporary_path, 'wb') as temporary_file:
+                np.save(temporary_file, array)
+            os.replace(temporary_path, cache_path)
+        except OSError as error:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            if self.verbose:
+                print('Could not save {0!s} to the cache: {1!s}'.format(\
+                    cache_path, error))
+
+    @property
+    def elevation_grid_digest(self):
+        """
+        Property storing the SHA-1 digest of the contents of the elevation
+        grid. Arrays derived from the grid are cached under this digest so
+        that they are recomputed if the elevation data changes, e.g. if a
+        different DEM is used for the same bounds.
+        """
+        if not hasattr(self, '_elevation_grid_digest'):
+            self._elevation_grid_digest = hashlib.sha1(\
+                np.ascontiguousarray(self.elevation_grid)).hexdigest()
+        return self._elevation_grid_digest
+
+    @property
+    def elevation_spline_coefficients(self):
+        """
+        Property storing the spline coefficients used to interpolate the
+        elevation data between grid points with
+        scipy.ndimage.map_coordinates. This step may take longer for
+        locations near the North or South Pole because there are more grid
+        points to interpolate between. If cache_directory is set, the
+        coefficients are saved there and memory-mapped on later runs with
+        the same bounds and elevation data.
+        """
+        if not hasattr(self, '_elevation_spline_coefficients'):
+            if self.elevation_interpolation_degree == 1:
+                # the interpolation kernels are compiled for C-contiguous
+                # arrays, so a transposed or sliced grid is copied once here
+                self._elevation_spline_coefficients =\
+                    np.ascontiguousarray(self.elevation_grid, dtype=np.float32)
+            else:
+                if self.cache_directory is None:
+                    cache_path = None
+                else:
+                    cache_path = self.cache_path('spline_coefficients',\
+                        self.elevation_grid_digest,\
+                        self.elevation_interpolation_degree)
+                if (cache_path is not None) and os.path.exists(cache_path):
+                    self._elevation_spline_coefficients =\
+                        np.load(cache_path, mmap_mode='r')
+                else:
+                    if self.verbose:
+                        print('Starting elevation interpolation...')
+                    t_start_interp = time.time()
+                    self._elevation_spline_coefficients = spline_filter(\
+                        self.elevation_grid,\
+                        order=self.elevation_interpolation_degree,\
+                        output=np.float32, mode='nearest')
+                    if cache_path is not None:
+                        self.save_to_cache(cache_path,\
+                            self._elevation_spline_coefficients)
+                    if self.verbose:
+                        print('Interpolated elevation data in %.2f minutes' %\
+                            ((time.time() - t_start_interp) / 60.))
+        return self._elevation_spline_coefficients
+
+    @property
+    def maximum_elevation(self):
+        """
+        Property storing an upper bound on the interpolated elevation, the
+        largest of the spline coefficients. The B-spline weights of the
+        coefficients are non-negative and sum to one, so no interpolated
+        elevation can exceed it.
+        """
+        if not hasattr(self, '_maximum_elevation'):
+            self._maximum_elevation =\
+                float(np.max(self.elevation_spline_coefficients))
+        return self._maximum_elevation
+
+    @property
+    def elevation_grid_spacing(self):
+        """
+        Property storing the mapping between coordinates and pixels of the
+        elevation grid in the form (lat_max, lat_resolution, lon_min,
+        lon_resolution), where lat_max is the latitude of the first row,
+        lon_min is the longitude (in [0, 360)) of the first column and the
+        resolutions are the spacings between adjacent pixels (in degrees).
+        """
+        if not hasattr(self, '_elevation_grid_spacing'):
+            lon_min = self.bounds[0] % 360.
+            lon_resolution = ((self.bounds[2] % 360.) - lon_min) /\
+                (self.elevation_grid.shape[1] - 1)
+            lat_resolution = (self.bounds[3] - self.bounds[1]) /\
+                (self.elevation_grid.shape[0] - 1)
+            self._elevation_grid_spacing =\
+                (self.bounds[3], lat_resolution, lon_min, lon_resolution)
+        return self._elevation_grid_spacing
+
+    def find_lon_lat(self, alpha, gamma, cos_gamma=None, sin_gamma=None,\
+        wrap_longitude=True):
         """
         This function calculates the longitude and latitude coordinate
         of a point given the location of the observer and an azimuthal
@@ -209,23 +463,100 @@ class BaseHorizonCalculator(object):
         alpha: azimuthal angle defined such that 0 corresponds to North
                and increases clockwise (in radians)
         gamma: angular distance (in radians)
-        coords: coordinates of the observer in the form (lon, lat)
+        cos_gamma: precomputed cos(gamma). If None, it is calculated here.
+        sin_gamma: precomputed sin(gamma). If None, it is calculated here.
+        wrap_longitude: if True, the longitude is wrapped into [-180, 180).
+                        If False, it is left within 180 degrees of the
+                        observer's longitude (so it may lie outside
+                        [-180, 180]), which saves a pass over the array when
+                        the caller reduces it mod 360 anyway.
+
+        alpha and gamma can be arrays as long as they broadcast together.
 
         Returns the longitude (l) and latitude (b) in degrees.
         """
-        theta_0 = (np.pi / 2.) - (self.observer_coordinates[1] * (np.pi / 180.))
-        phi_0 = self.observer_coordinates[0] * (np.pi / 180.)
-        theta = np.arccos((np.cos(theta_0) * np.cos(gamma)) +\
-            (np.cos(alpha) * np.sin(theta_0) * np.sin(gamma)))
-        phi = np.angle(((np.sin(theta_0) * np.cos(gamma)) +\
-            (1j * np.sin(alpha) * np.sin(gamma)) -\
-            (np.cos(alpha) * np.cos(theta_0) * np.sin(gamma))) *\
-            np.exp(1j * phi_0))
-        l = (180. / np.pi) * phi
-        b = 90. - ((180. / np.pi) * theta)
-        return l, b
+        if cos_gamma is None:
+            cos_gamma = np.cos(gamma)
+        if sin_gamma is None:
+            sin_gamma = np.sin(gamma)
+        cos_alpha = np.cos(alpha)
+        # the scalar factors are multiplied first and the sums are done in
+        # place so that only one full-size array is made per quantity
+        z = (cos_alpha * self._sin_theta_0) * sin_gamma
+        z += self._cos_theta_0 * cos_gamma
+        x = (cos_alpha * self._cos_theta_0) * sin_gamma
+        x *= -1.
+        x += self._sin_theta_0 * cos_gamma
+        y = np.sin(alpha) * sin_gamma
+        # the latitude is found from z and the distance from the polar axis
+        # rather than with arcsin(z), which loses precision near the poles
+        rho = x * x
+        rho += y * y
+        b = np.arctan2(z, np.sqrt(rho))
+        # rotating (x, y) by phi_0 is the same as adding phi_0 to its angle
+        phi = np.arctan2(y, x)
+        # convert to longitude and latitude in place to avoid new arrays
+        phi *= _RAD2DEG
+        phi += self.observer_coordinates[0]
+        if wrap_longitude:
+            phi += 180.
+            phi %= 360.
+            phi -= 180.
+        b *= _RAD2DEG
+        return phi, b
+
+    def interpolate_elevation_lon_lat(self, l, b, num_threads=None):
+        """
+        This function interpolates the height at the given longitude and
+        latitude from the elevation grid. If numba is installed, linear and
+        cubic splines are evaluated with horizon_kernels.interpolate_pixels;
+        otherwise scipy.ndimage.map_coordinates is used, split across threads
+        for large inputs.
+
+        l: longitude (in degrees)
+        b: latitude (in degrees)
+        num_threads: number of threads to use. If None, the num_threads
+                     property is used
+
+        Returns the elevation in meters.
+        """
+        if num_threads is None:
+            num_threads = self.num_threads
+        lat_max, lat_resolution, lon_min, lon_resolution =\
+            self.elevation_grid_spacing
+        pixel_coordinates = np.empty((2,) + np.broadcast(l, b).shape)
+        pixel_coordinates[0] = (lat_max - b) / lat_resolution
+        pixel_coordinates[1] = ((l % 360.) - lon_min) / lon_resolution
+        pixel_coordinates = pixel_coordinates.reshape(2, -1)
+        h = np.empty(pixel_coordinates.shape[1])
+        if horizon_kernels.have_numba and\
+            (self.elevation_interpolation_degree in [1, 3]):
+            horizon_kernels.set_thread_count(num_threads)
+            horizon_kernels.interpolate_pixels(\
+                self.elevation_spline_coefficients, pixel_coordinates[0],\
+                pixel_coordinates[1], self.elevation_interpolation_degree, h)
+        else:
+            def interpolate_chunk(chunk):
+                map_coordinates(self.elevation_spline_coefficients,\
+                    pixel_coordinates[:,chunk],\
+                    order=self.elevation_interpolation_degree, output=h[chunk],\
+                    mode='nearest', prefilter=False)
+            # map_coordinates releases the GIL, so threads can fill different
+            # parts of h at once
+            N_chunks = min(num_threads, -((-h.shape[0]) // _MAX_CHUNK_POINTS))
+            if N_chunks <= 1:
+                interpolate_chunk(slice(None))
+            else:
+                chunk_edges =\
+                    np.linspace(0, h.shape[0], N_chunks + 1).astype(int)
+                with ThreadPoolExecutor(N_chunks) as executor:
+                    list(executor.map(interpolate_chunk,\
+                        [slice(chunk_edges[i], chunk_edges[i+1])\
+                        for i in range(N_chunks)]))
+        return h.reshape(np.broadcast(l, b).shape)
 
-    def interpolate_elevation(self, alpha, gamma):
+    def interpolate_elevation(self, alpha, gamma, cos_gamma=None,\
+        sin_gamma=None):
         """
         This functions interpolates the height at the point defined by
         the given alpha and gamma from the elevation grid.
@@ -233,13 +564,18 @@ class BaseHorizonCalculator(object):
         alpha: azimuthal angle defined such that 0 corresponds to North
                and increases clockwise (in radians)
         gamma: angular distance (in radians)
+        cos_gamma: precomputed cos(gamma). If None, it is calculated here.
+        sin_gamma: precomputed sin(gamma). If None, it is calculated here.
+
+        alpha and gamma can be arrays as long as they broadcast together.
 
         Returns the elevation in meters.
         """
-        l, b = self.find_lon_lat(alpha, gamma)
-        return self.elevation_interpolation_function(l % 360., b, grid=False)
+        l, b = self.find_lon_lat(alpha, gamma, cos_gamma=cos_gamma,\
+            sin_gamma=sin_gamma, wrap_longitude=False)
+        return self.interpolate_elevation_lon_lat(l, b)
 
-    def horizon_angle(self, alpha, gamma):
+    def horizon_angle(self, alpha, gamma, cos_gamma=None, sin_gamma=None):
         """
         Calculates the horizon angle for a point defined by the angles alpha and gamma
         relative to the observer.
@@ -248,14 +584,55 @@ class BaseHorizonCalculator(object):
                observer's position and the point of interest, i.e. the azimuthal
                angle (in radians)
         gamma: the angular distance from the observer to the point of interest
-               (in radians)
+               (in radians). Can be an array, in which case an array of horizon
+               angles is returned.
+        cos_gamma: precomputed cos(gamma). If None, it is calculated here.
+        sin_gamma: precomputed sin(gamma). If None, it is calculated here.
+
+        Returns eta, the horizon angle of the point of interest, in radians.
+        """
+        if cos_gamma is None:
+            cos_gamma = np.cos(gamma)
+        if sin_gamma is None:
+            sin_gamma = np.sin(gamma)
+        h = self.interpolate_elevation(alpha, gamma, cos_gamma=cos_gamma,\
+            sin_gamma=sin_gamma)
+        return self.elevation_horizon_angle(h, cos_gamma, sin_gamma)
+
+    def elevation_horizon_angle(self, h, cos_gamma, sin_gamma):
+        """
+        Calculates the horizon angle of a point with the given elevation at
+        an angular distance gamma from the observer. The two terms of the
+        formula nearly cancel for small gamma, so the inputs should be
+        double precision.
+
+        h: elevation of the point of interest (in meters)
+        cos_gamma: cos(gamma)
+        sin_gamma: sin(gamma)
 
         Returns eta, the horizon angle of the point of interest, in radians.
         """
-        h = self.interpolate_elevation(alpha, gamma)
-        eta = np.arctan((1 / np.tan(gamma)) - (((self.body_radius +\
-            self.observer_elevation) / (self.body_radius + h)) / np.sin(gamma)))
-        return eta
+        return np.arctan(self.elevation_horizon_tangent(h,\
+            cos_gamma / sin_gamma, 1. / sin_gamma))
+
+    def elevation_horizon_tangent(self, h, cot_gamma, csc_gamma):
+        """
+        Calculates the tangent of the horizon angle of a point with the given
+        elevation at an angular distance gamma from the observer. Since the
+        arctangent is monotonic, the largest horizon angle along an azimuth
+        can be found from the tangents alone. cot(gamma) and csc(gamma) are
+        taken instead of cos(gamma) and sin(gamma) so that they can be
+        computed once for all azimuths.
+
+        h: elevation of the point of interest (in meters)
+        cot_gamma: cot(gamma)
+        csc_gamma: csc(gamma)
+
+        Returns tan(eta), where eta is the horizon angle of the point of
+        interest.
+        """
+        return cot_gamma -\
+            ((self.observer_radius * csc_gamma) / (self.body_radius + h))
 
     def horizon_profile(self, N_alpha, N_gamma, return_gamma_max=False):
         """
@@ -272,39 +649,77 @@ class BaseHorizonCalculator(object):
         angles making up the horizon profile (in degrees).
         """
         azimuths = np.linspace(0, 2*np.pi, N_alpha, endpoint=True)
-        gammas = np.linspace(self.gamma_min * (np.pi / 180.),\
-            self.gamma_max * (np.pi / 180.), N_gamma)
-        horizon_profile = []
-        horizon_gammas = []
-        try:
-            import progressbar
-            self.elevation_grid
-            self.elevation_interpolation_function
-            for i in progressbar.progressbar(np.arange(N_alpha)):
-                start = time.time()
-                horizon_angles = []
-                for gamma in gammas:
-                    horizon_angles += [self.horizon_angle(azimuths[i], gamma)]
-                horizon_profile += [np.amax(horizon_angles)]
-                horizon_gammas += [gammas[np.where(horizon_angles == np.amax(horizon_angles))][0]]
-        except ModuleNotFoundError:
-            self.elevation_grid
-            self.elevation_interpolation_function
-            for i in np.arange(N_alpha):
-                start = time.time()
-                horizon_angles = []
-                for gamma in gammas:
-                    horizon_angles += [self.horizon_angle(azimuths[i], gamma)]
-                horizon_profile += [np.amax(horizon_angles)]
-                print('alpha angle %i/%i completed in %.1f seconds...'\
-                    % (i+1, len(azimuths), time.time() - start))
+        gammas = np.linspace(self.gamma_min * _DEG2RAD,\
+            self.gamma_max * _DEG2RAD, N_gamma)
+        self.elevation_spline_coefficients
+        self.elevation_grid_spacing
+        self.observer_radius
+        horizon_profile = np.empty(N_alpha)
+        max_indices = np.empty(N_alpha, dtype=int)
+        # the last azimuth (2pi) is the same direction as the first (0), so
+        # it is copied from the first instead of being calculated
+        N_unique_alpha = max(N_alpha - 1, 1)
+        if horizon_kernels.have_numba and\
+            (self.elevation_interpolation_degree in [1, 3]):
+            lat_max, lat_resolution, lon_min, lon_resolution =\
+                self.elevation_grid_spacing
+            horizon_kernels.set_thread_count(self.num_threads)
+            with horizon_kernels.azimuth_schedule():
+                horizon_kernels.compute_horizon_profile(\
+                    self.elevation_spline_coefficients,\
+                    self.elevation_interpolation_degree, lat_max,\
+                    lat_resolution, lon_min, lon_resolution,\
+                    self._theta_0, self._phi_0, self.body_radius,\
+                    self.observer_radius, self.maximum_elevation,\
+                    azimuths[:N_unique_alpha], gammas,\
+                    horizon_profile[:N_unique_alpha],\
+                    max_indices[:N_unique_alpha])
+        else:
+            cos_gammas = np.cos(gammas)[np.newaxis,:]
+            sin_gammas = np.sin(gammas)[np.newaxis,:]
+            cot_gammas = cos_gammas / sin_gammas
+            csc_gammas = 1. / sin_gammas
+            def horizon_maxima(chunk):
+                l, b = self.find_lon_lat(azimuths[chunk,np.newaxis],\
+                    gammas[np.newaxis,:], cos_gamma=cos_gammas,\
+                    sin_gamma=sin_gammas, wrap_longitude=False)
+                horizon_tangents = self.elevation_horizon_tangent(\
+                    self.interpolate_elevation_lon_lat(l, b, num_threads=1),\
+                    cot_gammas, csc_gammas)
+                max_indices[chunk] = np.argmax(horizon_tangents, axis=1)
+                horizon_profile[chunk] = np.arctan(horizon_tangents[\
+                    np.arange(horizon_tangents.shape[0]), max_indices[chunk]])
+            # map_coordinates and NumPy release the GIL, so threads sharing the
+            # spline coefficients can work on different azimuths at once
+            # blocks of at most _MAX_CHUNK_POINTS points keep the temporary
+            # arrays small enough to stay in cache
+            N_chunks = min(max(self.num_threads,\
+                -((-N_unique_alpha * N_gamma) // _MAX_CHUNK_POINTS)),\
+                N_unique_alpha)
+            chunk_edges =\
+                np.linspace(0, N_unique_alpha, N_chunks + 1).astype(int)
+            chunks = [slice(chunk_edges[i], chunk_edges[i+1])\
+                for i in range(N_chunks)]
+            if self.num_threads == 1:
+                for chunk in chunks:
+                    horizon_maxima(chunk)
+            else:
+                with ThreadPoolExecutor(min(self.num_threads, N_chunks)) as\
+                    executor:
+                    list(executor.map(horizon_maxima, chunks))
+        if N_alpha > N_unique_alpha:
+            horizon_profile[N_unique_alpha:] = horizon_profile[0]
+            max_indices[N_unique_alpha:] = max_indices[0]
+        # the output arrays are local to this call, so they are converted to
+        # degrees in place and returned directly
+        azimuths *= _RAD2DEG
+        horizon_profile *= _RAD2DEG
         if return_gamma_max:
-            return np.array(azimuths) * (180. / np.pi),\
-                np.array(horizon_profile) * (180. / np.pi),\
-                np.array(horizon_gammas) * (180. / np.pi)
+            horizon_gammas = gammas[max_indices]
+            horizon_gammas *= _RAD2DEG
+            return azimuths, horizon_profile, horizon_gammas
         else:
-            return np.array(azimuths) * (180. / np.pi),\
-                np.array(horizon_profile) * (180. / np.pi)
+            return azimuths, horizon_profile
 
     def horizon_lon_lats(self, N_alpha, N_gamma):
         """
@@ -322,7 +737,7 @@ class BaseHorizonCalculator(object):
         horizon_azimuths, horizon_profile, horizon_gammas = self.horizon_profile(\
             N_alpha, N_gamma, return_gamma_max=True)
         horizon_lons, horizon_lats = self.find_lon_lat(\
-            horizon_azimuths * (np.pi / 180.), horizon_gammas * (np.pi / 180.))
+            horizon_azimuths * _DEG2RAD, horizon_gammas * _DEG2RAD)
         return horizon_lons, horizon_lats
 
     def plot_topo_map(self, plot_horizon=False, N_alpha=361, N_gamma=1000,\
@@ -340,6 +755,7 @@ class BaseHorizonCalculator(object):
               returns
         **kwargs: keyword arguments to pass to matplotlib.pyplot.imshow()
         """
+        import matplotlib.pyplot as plt
         fig, ax = plt.subplots()
         plt.scatter(self.observer_coordinates[0] % 360., self.observer_coordinates[1],\
             c='r', marker='*', s=50)
@@ -8,23 +8,100 @@ Description: File containing LunarHorizonCalculator class which reads
              location on the surface of the Moon.
 """
 import os
-import gc
+import math
 import time
+import threading
 import numpy as np
-import elevation
-import richdem as rd
-import matplotlib.pyplot as plt
-from osgeo import gdal, gdal_array
-from scipy.interpolate import RectBivariateSpline
+from osgeo import gdal
 from .BaseHorizonCalculator import BaseHorizonCalculator
 
+# GDAL settings which speed up reading windows of the large lunar DEMs. They
+# are applied the first time a lunar DEM is accessed (so importing shapes
+# for Earth alone leaves GDAL untouched), and each is only applied if it
+# hasn't already been set by the user (e.g. through an environment
+# variable). GDAL_CACHEMAX (in MB) lets the block cache hold all
+# of the tiles overlapping a window, GDAL_DISABLE_READDIR_ON_OPEN stops GDAL
+# from listing the (large) input directory to look for sidecar files and
+# GTIFF_VIRTUAL_MEM_IO memory-maps uncompressed files instead of copying
+# them through the block cache. VSI_CACHE and CPL_VSIL_CURL_CACHE_SIZE (in
+# bytes) keep the ranges already downloaded from DEMs on remote storage (see
+# elevation_data_directory) so they aren't requested again.
+gdal_config_options = {'GDAL_CACHEMAX': '1024',\
+    'GDAL_DISABLE_READDIR_ON_OPEN': 'TRUE',\
+    'GTIFF_VIRTUAL_MEM_IO': 'IF_ENOUGH_RAM',\
+    'VSI_CACHE': 'TRUE',\
+    'CPL_VSIL_CURL_CACHE_SIZE': '200000000'}
+_gdal_configured = False
+
+def _configure_gdal():
+    """
+    Applies gdal_config_options, unless that has already been done.
+    """
+    global _gdal_configured
+    if not _gdal_configured:
+        for (option, value) in gdal_config_options.items():
+            if gdal.GetConfigOption(option) is None:
+                gdal.SetConfigOption(option, value)
+        _gdal_configured = True
+
+def _stat_dataset(elevation_data_path):
+    """
+    Finds the status of the DEM at the given path. Unlike os.stat, this
+    also works for DEMs on remote storage (see elevation_data_directory).
+
+    elevation_data_path: path to the GeoTIFF containing the DEM
+
+    Returns the result of gdal.VSIStatL, or None if the DEM doesn't exist.
+    """
+    _configure_gdal()
+    return gdal.VSIStatL(elevation_data_path)
+
+# DEMs opened so far by each thread (a GDAL dataset must only be used by one
+# thread at a time), keyed by path and modification time
+_datasets = threading.local()
+
+def _open_dataset(elevation_data_path):
+    """
+    Opens the DEM at the given path, or returns the dataset opened by an
+    earlier call in the same thread if the file hasn't been modified since.
+    Keeping the datasets open means later calculators skip reading the
+    GeoTIFF header and tile index again and can reuse the tiles still held
+    in GDAL's block cache.
+
+    elevation_data_path: path to the GeoTIFF containing the DEM
+
+    Returns the osgeo.gdal.Dataset.
+    """
+    elevation_data_stat = _stat_dataset(elevation_data_path)
+    if elevation_data_stat is None:
+        raise IOError("Can't find the lunar DEM {!s}.".format(\
+            elevation_data_path))
+    if not hasattr(_datasets, 'datasets'):
+        _datasets.datasets = {}
+    key = (elevation_data_path, elevation_data_stat.mtime)
+    if key not in _datasets.datasets:
+        dataset = gdal.Open(elevation_data_path)
+        if dataset is None:
+            raise IOError("Can't open the lunar DEM {!s}.".format(\
+                elevation_data_path))
+        # datasets of earlier versions of the file are closed
+        for old_key in [old_key for old_key in _datasets.datasets\
+            if old_key[0] == elevation_data_path]:
+            del _datasets.datasets[old_key]
+        _datasets.datasets[key] = dataset
+    return _datasets.datasets[key]
+
 class LunarHorizonCalculator(BaseHorizonCalculator):
     """
     An object which calculates the angular horizon as seen from a
     location on the Moon at the given coordinates.
     """
+    default_grid_width = 20.
+    # volumetric mean radius of the Moon (in meters)
+    body_radius = 1.7374e6
+
     def __init__(self, observer_coordinates, observer_height=0.,\
-        gamma_min=0.005, gamma_max=8.0):
+        gamma_min=0.005, gamma_max=8.0, verbose=True):
         """
         Initializes a new LunarHorizonCalculator object with the given
         inputs.
@@ -35,40 +112,61 @@ class LunarHorizonCalculator(BaseHorizonCalculator):
                    horizon (in degrees)
         gamma_max: maximum angle which to consider in the calculation of the
                    horizon (in degrees)
+        verbose: if True, messages about the progress of slow steps are
+                 printed
         """
         self.observer_coordinates = observer_coordinates
         self.observer_height = observer_height
         self.gamma_min = gamma_min
         self.gamma_max = gamma_max
+        self.verbose = verbose
 
     @property
-    def body_radius(self):
+    def elevation_data_directory(self):
         """
-        Property storing the radius of the body (i.e. the Moon) in meters.
-        Note that this is the volumetric mean radius.
+        Property storing the directory containing the LOLA and LOLA_Kaguya
+        DEM directories. Defaults to $SHAPES/input. It can also be a path
+        GDAL reads from remote storage (e.g. '/vsicurl/https://...' or
+        '/vsis3/bucket/...'), in which case only the parts of the DEM
+        covering the bounds are downloaded, in as few requests as possible
+        if the DEMs are Cloud Optimized GeoTIFFs.
         """
-        if not hasattr(self, '_body_radius'):
-            self._body_radius = 1.7374e6
-        return self._body_radius
+        if not hasattr(self, '_elevation_data_directory'):
+            self._elevation_data_directory =\
+                '{!s}/input'.format(os.getenv('SHAPES'))
+        return self._elevation_data_directory
+
+    @elevation_data_directory.setter
+    def elevation_data_directory(self, value):
+        """
+        Setter for the elevation_data_directory property.
+
+        value: local path or GDAL virtual file system path of a directory
+        """
+        self._elevation_data_directory = value
 
     @property
     def use_SLDEM(self):
         if not hasattr(self, '_use_SLDEM'):
             min_lat = self.bounds[1]
             max_lat = self.bounds[3]
-            path_to_SLDEM = '{!s}/input/'.format(os.getenv('SHAPES')) +\
+            path_to_SLDEM = '{!s}/'.format(self.elevation_data_directory) +\
                 'LOLA_Kaguya/Lunar_LRO_LOLAKaguya_DEMmerge_60N60S_512ppd.tif'
-            if (min_lat > -60.) and (max_lat < 60.) and os.path.exists(path_to_SLDEM):
-                print('Elevation grid is within 60 deg S and 60 deg N, '+\
-                    'using high resolution SLDEM (SELENE + LOLA).')
+            SLDEM_exists = (_stat_dataset(path_to_SLDEM) is not None)
+            if (min_lat > -60.) and (max_lat < 60.) and SLDEM_exists:
+                message = 'Elevation grid is within 60 deg S and 60 deg N, ' +\
+                    'using high resolution SLDEM (SELENE + LOLA).'
                 self._use_SLDEM = True
-            elif not os.path.exists(path_to_SLDEM):
-                print('High resolution SLDEM file not found, using LOLA Global DEM.')
+            elif not SLDEM_exists:
+                message = 'High resolution SLDEM file not found, using ' +\
+                    'LOLA Global DEM.'
                 self._use_SLDEM = False
             else:
-                print('Elevation grid extends below 60 deg S or above 60 deg N, '+\
-                    'using LOLA Global DEM.')
+                message = 'Elevation grid extends below 60 deg S or above ' +\
+                    '60 deg N, using LOLA Global DEM.'
                 self._use_SLDEM = False
+            if self.verbose:
+                print(message)
         return self._use_SLDEM
 
     @property
@@ -101,88 +199,169 @@ class LunarHorizonCalculator(BaseHorizonCalculator):
         return self._latitude_resolution
 
     @property
-    def grid_width_longitude(self):
+    def elevation_data_path(self):
         """
-        Property storing the size of the elevation grid in longitude.
+        Property storing the path to the GeoTIFF containing the DEM.
         """
-        if not hasattr(self, '_grid_width_longitude'):
-            self._grid_width_longitude = 20.
-        return self._grid_width_longitude
+        if not hasattr(self, '_elevation_data_path'):
+            if self.use_SLDEM:
+                self._elevation_data_path =\
+                    '{!s}/'.format(self.elevation_data_directory) +\
+                    'LOLA_Kaguya/Lunar_LRO_LOLAKaguya_DEMmerge_60N60S_512ppd.tif'
+            else:
+                self._elevation_data_path =\
+                    '{!s}/'.format(self.elevation_data_directory) +\
+                    'LOLA/Lunar_LRO_LOLA_Global_LDEM_118m_Mar2014.tif'
+        return self._elevation_data_path
+
+    @property
+    def elevation_data_max_latitude(self):
+        """
+        Property storing the latitude of the top edge of the DEM (in
+        degrees). The DEMs are symmetric about the equator and span all
+        longitudes.
+        """
+        if not hasattr(self, '_elevation_data_max_latitude'):
+            if self.use_SLDEM:
+                self._elevation_data_max_latitude = 60.
+            else:
+                self._elevation_data_max_latitude = 90.
+        return self._elevation_data_max_latitude
 
-    @grid_width_longitude.setter
-    def grid_width_longitude(self, value):
+    @property
+    def pixel_window(self):
         """
-        Setter for the grid_width_longitude property.
-        Value: positive number greater than gamma_max
+        Property storing the window of the DEM covering the bounds in the
+        form (first_row, end_row, first_column, end_column), where the end
+        row and column are one past the last ones in the window. If the
+        bounds cross the antimeridian, end_column is smaller than
+        first_column and the window wraps around the edge of the DEM.
         """
-        if value < self.gamma_max:
-            raise ValueError('grid_width_longitude must be larger' +\
-                'than gamma_max.')
-        self._grid_width_longitude = value
+        if not hasattr(self, '_pixel_window'):
+            max_lat = self.elevation_data_max_latitude
+            (lon_min, lat_min, lon_max, lat_max) =\
+                (float(bound) for bound in self.bounds)
+            # the elevations are at the pixel centres, so the window starts
+            # and ends with the pixels whose centres are at or beyond the
+            # bounds (pixel k is centred k + 0.5 pixels from the edge of the
+            # DEM), plus one more pixel on each side to support the cubic
+            # spline, clipped to the DEM
+            margin = 1
+            first_row = max(math.floor(((max_lat - lat_max) * self.ppd) -\
+                0.5) - margin, 0)
+            end_row = min(math.ceil(((max_lat - lat_min) * self.ppd) + 0.5) +\
+                margin, int(2 * max_lat) * self.ppd)
+            first_column = max(math.floor(((180. + lon_min) * self.ppd) -\
+                0.5) - margin, 0)
+            end_column = min(math.ceil(((180. + lon_max) * self.ppd) + 0.5) +\
+                margin, 360 * self.ppd)
+            self._pixel_window = (first_row, end_row, first_column, end_column)
+        return self._pixel_window
 
     @property
-    def grid_width_latitude(self):
+    def elevation_data_transform(self):
         """
-        Property storing the size of the elevation grid in latitude.
+        Property storing the position of the pixels of the DEM in the form
+        (lon_min, lon_resolution, lat_max, lat_resolution), where lon_min and
+        lat_max are the longitude and latitude of the centre of the first
+        pixel and the resolutions are the spacings between pixels (all in
+        degrees). These come from the geotransform of the GeoTIFF, which
+        gives the corner of the first pixel (the DEMs are pixel-is-area) in
+        the units of its simple cylindrical projection (meters for the LOLA
+        DEMs). The units are converted to degrees using the fact that the
+        DEM spans all longitudes.
         """
-        if not hasattr(self, '_grid_width_latitude'):
-            self._grid_width_latitude = 20.
-        return self._grid_width_latitude
+        if not hasattr(self, '_elevation_data_transform'):
+            dataset = _open_dataset(self.elevation_data_path)
+            (x_origin, x_pixel_size, x_rotation, y_origin, y_rotation,\
+                y_pixel_size) = dataset.GetGeoTransform()
+            degrees_per_unit = 360. / (dataset.RasterXSize * x_pixel_size)
+            self._elevation_data_transform =\
+                ((x_origin + (x_pixel_size / 2.)) * degrees_per_unit,\
+                x_pixel_size * degrees_per_unit,\
+                (y_origin + (y_pixel_size / 2.)) * degrees_per_unit,\
+                -y_pixel_size * degrees_per_unit)
+        return self._elevation_data_transform
 
-    @grid_width_latitude.setter
-    def grid_width_latitude(self, value):
+    @property
+    def elevation_grid_spacing(self):
         """
-        Setter for the grid_width_latitude property.
-        Value: positive number greater than gamma_max
+        Property storing the mapping between coordinates and pixels of the
+        elevation grid (see BaseHorizonCalculator.elevation_grid_spacing).
+        The grid is a window of the DEM, so the mapping is taken from the
+        positions of the pixels actually read (see elevation_data_transform)
+        rather than by stretching the grid over the bounds, which would
+        misplace it by up to a pixel.
         """
-        if value < self.gamma_max:
-            raise ValueError('grid_width_latitude must be larger' +\
-                'than gamma_max.')
-        self._grid_width_latitude = value
+        if not hasattr(self, '_elevation_grid_spacing'):
+            (first_row, end_row, first_column, end_column) = self.pixel_window
+            (lon_min, lon_resolution, lat_max, lat_resolution) =\
+                self.elevation_data_transform
+            self._elevation_grid_spacing =\
+                (lat_max - (first_row * lat_resolution), lat_resolution,\
+                (lon_min + (first_column * lon_resolution)) % 360.,\
+                lon_resolution)
+        return self._elevation_grid_spacing
 
     @property
     def elevation_grid(self):
         """
-        Property storing the grid containing the elevation data.
+        Property storing the grid containing the elevation data. If the DEM
+        is on remote storage (see elevation_data_directory) and
+        cache_directory is set, the grid is saved there and memory-mapped on
+        later runs with the same bounds and DEM. Local DEMs are uncompressed,
+        so windows of them are read directly instead, which is as fast as
+        reading a cached copy.
         """
         if not hasattr(self, '_elevation_grid'):
-            t_start = time.time()
-            if self.use_SLDEM:
-                elevation_data_path = '{!s}/input/'.format(os.getenv('SHAPES')) +\
-                    'LOLA_Kaguya/Lunar_LRO_LOLAKaguya_DEMmerge_60N60S_512ppd.tif'
-                max_lat = 60.
+            elevation_data_path = self.elevation_data_path
+            elevation_data_stat = _stat_dataset(elevation_data_path)
+            if elevation_data_stat is None:
+                raise IOError(("Can't find the lunar DEM {!s}. It can be " +\
+                    "downloaded with remote.py.").format(elevation_data_path))
+            if (self.cache_directory is None) or\
+                (not elevation_data_path.startswith('/vsi')):
+                cache_path = None
             else:
-                elevation_data_path = '{!s}/input/'.format(os.getenv('SHAPES')) +\
-                    'LOLA/Lunar_LRO_LOLA_Global_LDEM_118m_Mar2014.tif'
-                max_lat = 90.
-            raster_array = gdal_array.LoadFile(elevation_data_path)
-            raster_res_deg = 1. / self.ppd
-            lat_bounds_pix =\
-                (np.ceil((max_lat - self.bounds[3]) / raster_res_deg).astype(int),\
-                np.ceil((max_lat - self.bounds[1]) / raster_res_deg).astype(int))
-            if (self.bounds[0] > 0.) and (self.bounds[2] < 0.):
-                lon_bound_pix_west =\
-                    np.ceil((180. + self.bounds[0]) / raster_res_deg).astype(int)
-                lon_bound_pix_east =\
-                    np.ceil((180. + self.bounds[2]) / raster_res_deg).astype(int)
-                elevation_grid_west =\
-                    raster_array[lat_bounds_pix[0]:lat_bounds_pix[1],\
-                    lon_bound_pix_west:]
-                elevation_grid_east =\
-                    raster_array[lat_bounds_pix[0]:lat_bounds_pix[1],\
-                    :lon_bound_pix_east]
-                self._elevation_grid =\
-                    np.concatenate((elevation_grid_west, elevation_grid_east), axis=-1)
-                del elevation_grid_west
-                del elevation_grid_east
+                cache_path = self.cache_path('elevation_grid',\
+                    elevation_data_path, elevation_data_stat.mtime,\
+                    self.pixel_window)
+            if (cache_path is not None) and os.path.exists(cache_path):
+                self._elevation_grid = np.load(cache_path, mmap_mode='r')
             else:
-                lon_bounds_pix =\
-                    (np.ceil((180. + self.bounds[0]) / raster_res_deg).astype(int),\
-                    np.ceil((180. + self.bounds[2]) / raster_res_deg).astype(int))
-                self._elevation_grid =\
-                    raster_array[lat_bounds_pix[0]:lat_bounds_pix[1],\
-                    lon_bounds_pix[0]:lon_bounds_pix[1]]
-            del raster_array ; gc.collect()
+                self._elevation_grid = self.read_elevation_grid()
+                if cache_path is not None:
+                    self.save_to_cache(cache_path, self._elevation_grid)
+        return self._elevation_grid
+
+    def read_elevation_grid(self):
+        """
+        Reads the window of the lunar DEM given by pixel_window.
+
+        Returns the elevation grid as a C-contiguous float32 array.
+        """
+        t_start = time.time()
+        dataset = _open_dataset(self.elevation_data_path)
+        raster_band = dataset.GetRasterBand(1)
+        (first_row, end_row, first_column, end_column) = self.pixel_window
+        lat_size_pix = end_row - first_row
+        if end_column < first_column:
+            west_size_pix = dataset.RasterXSize - first_column
+            # the strips on either side of the antimeridian are read straight
+            # into their halves of the grid instead of being concatenated
+            elevation_grid = np.empty(\
+                (lat_size_pix, west_size_pix + end_column), dtype=np.float32)
+            raster_band.ReadAsArray(first_column, first_row, west_size_pix,\
+                lat_size_pix, buf_obj=elevation_grid[:,:west_size_pix])
+            raster_band.ReadAsArray(0, first_row, end_column, lat_size_pix,\
+                buf_obj=elevation_grid[:,west_size_pix:])
+        else:
+            elevation_grid = raster_band.ReadAsArray(first_column, first_row,\
+                end_column - first_column, lat_size_pix,\
+                buf_type=gdal.GDT_Float32)
+        # ReadAsArray already converted the data to float32 while reading
+        elevation_grid = np.ascontiguousarray(elevation_grid)
+        if self.verbose:
             print('Read lunar elevation data in %.2f minutes' %\
                 ((time.time() - t_start) / 60.))
-        return self._elevation_grid
+        return elevation_grid
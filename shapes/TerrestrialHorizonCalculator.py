@@ -8,12 +8,9 @@ Description: File containing Terrestrial HorizonCalculator class which reads
              on Earth location.
 """
 import os
-import time
+import tempfile
 import numpy as np
-import elevation
-import richdem as rd
-import matplotlib.pyplot as plt
-from scipy.interpolate import RectBivariateSpline
+from osgeo import gdal
 from .BaseHorizonCalculator import BaseHorizonCalculator
 
 class TerrestrialHorizonCalculator(BaseHorizonCalculator):
@@ -21,8 +18,15 @@ class TerrestrialHorizonCalculator(BaseHorizonCalculator):
     Class that calculates the angular horizon as seen from a
     location on Earth at the given coordinates.
     """
+    default_grid_width = 2.
+    # volumetric mean radius of the Earth (in meters)
+    body_radius = 6.371000e6
+    # size of an elevation grid pixel (1 arcsecond SRTM data) in degrees
+    longitude_resolution = 1 / (60 * 60)
+    latitude_resolution = 1 / (60 * 60)
+
     def __init__(self, observer_coordinates, observer_height=0.,\
-        gamma_min=0.005, gamma_max=0.5):
+        gamma_min=0.005, gamma_max=0.5, verbose=True):
         """
         Initializes a new TerrestrialHorizonCalculator object with the given
         inputs.
@@ -33,92 +37,91 @@ class TerrestrialHorizonCalculator(BaseHorizonCalculator):
                    horizon (in degrees)
         gamma_max: maximum angle which to consider in the calculation of the
                    horizon (in degrees)
+        verbose: if True, messages about the progress of slow steps are
+                 printed
         """
         self.observer_coordinates = observer_coordinates
         self.gamma_min = gamma_min
         self.gamma_max = gamma_max
+        self.verbose = verbose
         self.observer_height = observer_height
 
     @property
-    def body_radius(self):
-        """
-        Property storing the radius of the body (i.e. the Earth) in meters.
-        Note that this is the volumetric mean radius.
-        """
-        if not hasattr(self, '_body_radius'):
-            self._body_radius = 6.371000e6
-        return self._body_radius
-
-    @property
-    def longitude_resolution(self):
-        """
-        Property storing the size of an elevation grid pixel in
-        longitude.
-        """
-        if not hasattr(self, '_longitude_resolution'):
-            self._longitude_resolution = 1 / (60 * 60)
-        return self._longitude_resolution
-
-    @property
-    def latitude_resolution(self):
+    def elevation_grid(self):
         """
-        Property storing the size of an elevation grid pixel in
-        latitude.
+        Property storing the grid containing the elevation data. If
+        cache_directory is set, the grid (and its geotransform) is saved
+        there and memory-mapped on later runs with the same bounds, so the
+        SRTM data only needs to be downloaded and clipped once for each
+        location.
         """
-        if not hasattr(self, '_latitude_resolution'):
-            self._latitude_resolution = 1 / (60 * 60)
-        return self._latitude_resolution
+        if not hasattr(self, '_elevation_grid'):
+            cache_path = self.cache_path('elevation_grid')
+            transform_cache_path = self.cache_path('elevation_grid_transform')
+            if (cache_path is not None) and os.path.exists(cache_path) and\
+                (transform_cache_path is not None) and\
+                os.path.exists(transform_cache_path):
+                self._elevation_grid = np.load(cache_path, mmap_mode='r')
+                self._elevation_grid_transform =\
+                    tuple(np.load(transform_cache_path).tolist())
+            else:
+                (self._elevation_grid, self._elevation_grid_transform) =\
+                    self.read_elevation_grid()
+                if (cache_path is not None) and\
+                    (transform_cache_path is not None):
+                    self.save_to_cache(cache_path, self._elevation_grid)
+                    self.save_to_cache(transform_cache_path,\
+                        np.array(self._elevation_grid_transform))
+        return self._elevation_grid
 
     @property
-    def grid_width_longitude(self):
-        """
-        Property storing the size of the elevation grid in longitude.
+    def elevation_grid_transform(self):
         """
-        if not hasattr(self, '_grid_width_longitude'):
-            self._grid_width_longitude = 2.
-        return self._grid_width_longitude
-
-    @grid_width_longitude.setter
-    def grid_width_longitude(self, value):
-        """
-        Setter for the grid_width_longitude property.
-
-        Value: positive number greater than gamma_max
+        Property storing the GDAL geotransform of the clipped SRTM DEM that
+        the elevation grid was read from, i.e. (lon_origin, lon_resolution,
+        0, lat_origin, 0, -lat_resolution), where the origin is the corner
+        of the first pixel (in degrees).
         """
-        if value < self.gamma_max:
-            raise ValueError('grid_width_longitude must be larger' +\
-                'than gamma_max.')
-        self._grid_width_longitude = value
+        if not hasattr(self, '_elevation_grid_transform'):
+            self.elevation_grid
+        return self._elevation_grid_transform
 
     @property
-    def grid_width_latitude(self):
-        """
-        Property storing the size of the elevation grid in latitude.
-        """
-        if not hasattr(self, '_grid_width_latitude'):
-            self._grid_width_latitude = 2.
-        return self._grid_width_latitude
-
-    @grid_width_latitude.setter
-    def grid_width_latitude(self, value):
-        """
-        Setter for the grid_width_latitude property.
+    def elevation_grid_spacing(self):
+        """
+        Property storing the mapping between coordinates and pixels of the
+        elevation grid (see BaseHorizonCalculator.elevation_grid_spacing).
+        The clipped DEM is snapped to the SRTM pixels, so the mapping is
+        taken from its geotransform (shifted to the pixel centres) rather
+        than by stretching the grid over the bounds, which would misplace it
+        by up to a pixel.
+        """
+        if not hasattr(self, '_elevation_grid_spacing'):
+            (lon_origin, lon_resolution, lon_rotation, lat_origin,\
+                lat_rotation, lat_pixel_size) = self.elevation_grid_transform
+            self._elevation_grid_spacing =\
+                (lat_origin + (lat_pixel_size / 2.), -lat_pixel_size,\
+                (lon_origin + (lon_resolution / 2.)) % 360., lon_resolution)
+        return self._elevation_grid_spacing
 
-        Value: positive number greater than gamma_max
+    def read_elevation_grid(self):
         """
-        if value < self.gamma_max:
-            raise ValueError('grid_width_latitude must be larger' +\
-                'than gamma_max.')
-        self._grid_width_latitude = value
+        Downloads (if necessary) and clips the SRTM data covering the bounds
+        of the elevation grid using the elevation package.
 
-    @property
-    def elevation_grid(self):
-        """
-        Property storing the grid containing the elevation data.
-        """
-        if not hasattr(self, '_elevation_grid'):
-            dem_path = os.path.join(os.getcwd(), 'DEM.tif')
+        Returns the elevation grid as a C-contiguous float32 array and the
+        geotransform of the clipped DEM.
+        """
+        import elevation
+        # the DEM is clipped into a private temporary directory so that
+        # calculators running at the same time don't overwrite each other's
+        # files
+        with tempfile.TemporaryDirectory() as dem_directory:
+            dem_path = os.path.join(dem_directory, 'DEM.tif')
             elevation.clip(bounds=self.bounds, output=dem_path)
-            self._elevation_grid = np.array(rd.LoadGDAL(dem_path))
-            os.remove('DEM.tif')
-        return self._elevation_grid
+            dataset = gdal.Open(dem_path)
+            elevation_grid = dataset.GetRasterBand(1).ReadAsArray(\
+                buf_type=gdal.GDT_Float32)
+            elevation_grid_transform = dataset.GetGeoTransform()
+            del dataset
+        return (elevation_grid, elevation_grid_transform)
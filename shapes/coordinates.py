@@ -6,10 +6,22 @@ Date: 19 April 2021
 Description: File containing coordinates of several different global 21-cm
              experiments in the form (longitude, latitude).
 """
+import types
 
-CTP_coordinates = (-79.823038, 38.433727)
-EDGES_coordinates = (116.603480, -26.714923)
-REACH_coordinates = (21.375833, -30.833611)
-PRIZM_coordinates = (37.820044, -46.886820)
-SARAS_coordinates = (74.876027, 13.992163)
-MIST_coordinates = (-90.748944, 79.415194)
+_coordinates = {'CTP': (-79.823038, 38.433727),\
+    'EDGES': (116.603480, -26.714923),\
+    'REACH': (21.375833, -30.833611),\
+    'PRIZM': (37.820044, -46.886820),\
+    'SARAS': (74.876027, 13.992163),\
+    'MIST': (-90.748944, 79.415194)}
+
+CTP_coordinates = _coordinates['CTP']
+EDGES_coordinates = _coordinates['EDGES']
+REACH_coordinates = _coordinates['REACH']
+PRIZM_coordinates = _coordinates['PRIZM']
+SARAS_coordinates = _coordinates['SARAS']
+MIST_coordinates = _coordinates['MIST']
+
+# read-only view of all of the coordinates keyed by experiment name, e.g. for
+# calculating the horizons of every site in a batch
+all_coordinates = types.MappingProxyType(_coordinates)
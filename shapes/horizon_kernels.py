@@ -0,0 +1,222 @@
+"""
+File: shapes/horizon_kernels.py
+Date: 15 October 2026
+
+Description: File containing numba-compiled kernels which calculate the
+             horizon profile directly from the spline coefficients of the
+             elevation grid. numba is optional; if it is not installed,
+             have_numba is False and BaseHorizonCalculator falls back on
+             its NumPy implementation. The compiled kernels are cached in
+             __pycache__, so they are only compiled the first time they
+             are used.
+"""
+import math
+import contextlib
+import numpy as np
+try:
+    from numba import njit, prange, set_num_threads, config
+    have_numba = True
+except ImportError:
+    have_numba = False
+
+# number of azimuths handed to a thread at a time by compute_horizon_profile
+azimuth_chunk_size = 4
+
+if have_numba:
+    def azimuth_schedule():
+        """
+        Returns a context manager inside which prange loops hand out
+        azimuth_chunk_size iterations at a time to whichever thread is free
+        instead of splitting the azimuths into one equal block per thread.
+        Azimuths do not all cost the same (rays crossing more grid cells or
+        rejected less often are slower), so equal blocks leave threads idle.
+        Versions of numba without parallel_chunksize keep equal blocks.
+        """
+        try:
+            from numba import parallel_chunksize
+        except ImportError:
+            return contextlib.nullcontext()
+        return parallel_chunksize(azimuth_chunk_size)
+
+    def set_thread_count(num_threads):
+        """
+        Sets the number of threads used by the parallel kernels, capped at
+        the number of threads numba was started with.
+        """
+        set_num_threads(max(1, min(num_threads, config.NUMBA_NUM_THREADS)))
+
+    @njit(fastmath=True, cache=True)
+    def _bspline_weights(t, order, weights):
+        """
+        Fills weights with the B-spline weights of the order+1 coefficients
+        surrounding a point a fraction t of the way between two grid points.
+        """
+        if order == 1:
+            weights[0] = 1. - t
+            weights[1] = t
+        else:
+            one_minus_t = 1. - t
+            weights[0] = (one_minus_t ** 3) / 6.
+            weights[1] = ((3. * (t ** 3)) - (6. * (t ** 2)) + 4.) / 6.
+            weights[2] =\
+                ((-3. * (t ** 3)) + (3. * (t ** 2)) + (3. * t) + 1.) / 6.
+            weights[3] = (t ** 3) / 6.
+
+    @njit(fastmath=True, cache=True)
+    def _gather_patch(coefficients, row_floor, column_floor, order, patch):
+        """
+        Copies the (order+1)x(order+1) spline coefficients which contribute
+        to points in the grid cell starting at (row_floor, column_floor)
+        into patch, clamping indices at the edges of the grid.
+        """
+        N_rows, N_columns = coefficients.shape
+        offset = (order - 1) // 2
+        for m in range(order + 1):
+            i = min(max(row_floor - offset + m, 0), N_rows - 1)
+            for n in range(order + 1):
+                j = min(max(column_floor - offset + n, 0), N_columns - 1)
+                patch[m,n] = coefficients[i,j]
+
+    @njit(fastmath=True, cache=True)
+    def _evaluate_patch(patch, row_fraction, column_fraction, order,\
+        row_weights, column_weights):
+        """
+        Evaluates the spline at a point a fraction (row_fraction,
+        column_fraction) of the way across the grid cell whose coefficients
+        are stored in patch.
+        """
+        _bspline_weights(row_fraction, order, row_weights)
+        _bspline_weights(column_fraction, order, column_weights)
+        h = 0.
+        for m in range(order + 1):
+            row_sum = 0.
+            for n in range(order + 1):
+                row_sum += column_weights[n] * patch[m,n]
+            h += row_weights[m] * row_sum
+        return h
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def interpolate_pixels(coefficients, rows, columns, order, h):
+        """
+        Evaluates the spline defined by coefficients at each of the
+        fractional pixel coordinates (rows[k], columns[k]) and writes the
+        results into h, distributing blocks of points across threads.
+        Equivalent to scipy.ndimage.map_coordinates with prefilter=False
+        and mode='nearest'. Only orders 1 and 3 are supported.
+
+        coefficients: spline coefficients of the elevation grid
+        rows, columns: 1D arrays of fractional pixel coordinates
+        order: spline order (1 or 3)
+        h: 1D float64 array, the same length as rows, to fill
+        """
+        block_size = 1024
+        N_blocks = (rows.shape[0] + block_size - 1) // block_size
+        for block in prange(N_blocks):
+            row_weights = np.empty(4)
+            column_weights = np.empty(4)
+            patch = np.empty((4, 4))
+            for k in range(block * block_size,\
+                min((block + 1) * block_size, rows.shape[0])):
+                row_floor = int(math.floor(rows[k]))
+                column_floor = int(math.floor(columns[k]))
+                _gather_patch(coefficients, row_floor, column_floor, order,\
+                    patch)
+                h[k] = _evaluate_patch(patch, rows[k] - row_floor,\
+                    columns[k] - column_floor, order, row_weights,\
+                    column_weights)
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def compute_horizon_profile(coefficients, order, lat_max, lat_resolution,\
+        lon_min, lon_resolution, theta_0, phi_0, body_radius,\
+        observer_radius, maximum_elevation, azimuths, gammas, horizon_profile,\
+        max_indices):
+        """
+        Calculates the maximum horizon angle (in radians) along each azimuth
+        and the index of the gamma at which it occurs, writing them into
+        horizon_profile and max_indices. Azimuths are distributed across
+        threads. Consecutive gammas along an azimuth usually fall in the same
+        grid cell, so the coefficients of a cell are only gathered from the
+        grid when the ray enters a new cell. Points which cannot exceed the
+        running maximum along an azimuth are rejected before the arctangent
+        is calculated, and an azimuth is abandoned once not even terrain at
+        maximum_elevation could exceed its running maximum at any further
+        gamma.
+
+        coefficients: spline coefficients of the elevation grid
+        order: spline order (1 or 3)
+        lat_max: latitude of the first row of the grid (in degrees)
+        lat_resolution: latitude spacing of the rows (in degrees)
+        lon_min: longitude of the first column of the grid, in [0, 360)
+        lon_resolution: longitude spacing of the columns (in degrees)
+        theta_0, phi_0: colatitude and longitude of the observer (in radians)
+        body_radius: radius of the body (in meters)
+        observer_radius: body_radius plus the elevation of the observer
+        maximum_elevation: upper bound on the interpolated elevation
+        azimuths, gammas: 1D arrays of alpha and gamma angles (in radians)
+        """
+        rad2deg = 180. / np.pi
+        cos_theta_0 = math.cos(theta_0)
+        sin_theta_0 = math.sin(theta_0)
+        cos_gammas = np.cos(gammas)
+        sin_gammas = np.sin(gammas)
+        cot_gammas = 1. / np.tan(gammas)
+        csc_gammas = 1. / sin_gammas
+        # largest tan(eta) possible at or beyond each gamma
+        remaining_upper_bounds = cot_gammas -\
+            ((observer_radius / (body_radius + maximum_elevation)) * csc_gammas)
+        for j in range(gammas.shape[0] - 2, -1, -1):
+            remaining_upper_bounds[j] =\
+                max(remaining_upper_bounds[j], remaining_upper_bounds[j + 1])
+        for i in prange(azimuths.shape[0]):
+            row_weights = np.empty(4)
+            column_weights = np.empty(4)
+            patch = np.empty((4, 4))
+            patch_row = 0
+            patch_column = 0
+            have_patch = False
+            cos_alpha = math.cos(azimuths[i])
+            sin_alpha = math.sin(azimuths[i])
+            max_eta = 0.
+            tan_max_eta = 0.
+            max_index = 0
+            for j in range(gammas.shape[0]):
+                if (j > 0) and (remaining_upper_bounds[j] < tan_max_eta):
+                    break
+                theta = math.acos((cos_theta_0 * cos_gammas[j]) +\
+                    (cos_alpha * sin_theta_0 * sin_gammas[j]))
+                x = (sin_theta_0 * cos_gammas[j]) -\
+                    (cos_alpha * cos_theta_0 * sin_gammas[j])
+                y = sin_alpha * sin_gammas[j]
+                phi = math.atan2(y, x) + phi_0
+                l = (rad2deg * phi) % 360.
+                b = 90. - (rad2deg * theta)
+                row = (lat_max - b) / lat_resolution
+                column = (l - lon_min) / lon_resolution
+                row_floor = int(math.floor(row))
+                column_floor = int(math.floor(column))
+                if (not have_patch) or (row_floor != patch_row) or\
+                    (column_floor != patch_column):
+                    _gather_patch(coefficients, row_floor, column_floor,\
+                        order, patch)
+                    patch_row = row_floor
+                    patch_column = column_floor
+                    have_patch = True
+                h = _evaluate_patch(patch, row - row_floor,\
+                    column - column_floor, order, row_weights, column_weights)
+                if j > 0:
+                    # eta > max_eta only if
+                    # (body_radius + h) * (cos(gamma) - tan(max_eta) *
+                    # sin(gamma)) > observer_radius, which is much cheaper
+                    # to check than calculating eta itself
+                    denominator =\
+                        cos_gammas[j] - (tan_max_eta * sin_gammas[j])
+                    if ((body_radius + h) * denominator) < observer_radius:
+                        continue
+                eta = math.atan(cot_gammas[j] -\
+                    ((observer_radius / (body_radius + h)) * csc_gammas[j]))
+                if (j == 0) or (eta > max_eta):
+                    max_eta = eta
+                    tan_max_eta = math.tan(eta)
+                    max_index = j
+            horizon_profile[i] = max_eta
+            max_indices[i] = max_index